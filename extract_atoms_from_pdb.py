@@ -1,8 +1,11 @@
+from __future__ import print_function
 from pdb_to_psf import *
 
 m = Molecule(sys.argv[1])
-print >>sys.stderr, "You want %s atoms." % sys.argv[2]
-my_atoms = [a for a in m.atoms if a.atomname == sys.argv[2]]
-first_resid = my_atoms[0].resid
-for a in my_atoms:
-    print "%d %f %f %f" % (a.resid - first_resid + 1, a.x, a.y, a.z)
+print("You want %s atoms." % sys.argv[2], file=sys.stderr)
+atomname = sys.argv[2].encode()
+my_atoms = [row for row in zip(m.column('atomname'), m.column('resid'), m.column('x'), m.column('y'), m.column('z'))
+            if row[0] == atomname]
+first_resid = my_atoms[0][1]
+for (name, resid, x, y, z) in my_atoms:
+    print("%d %f %f %f" % (resid - first_resid + 1, x, y, z))
@@ -1,8 +1,10 @@
+from __future__ import print_function
 from pdb_to_psf import *
 
 m = Molecule(sys.argv[1])
-print >>sys.stderr, "This is a list of Gly residues (that don't have CB atoms)."
-my_atoms = [a for a in m.atoms if a.resname == "GLY" and a.atomname == "N"]
-first_resid = my_atoms[0].resid
-for a in my_atoms:
-	print (a.resid - first_resid + 1)
+print("This is a list of Gly residues (that don't have CB atoms).", file=sys.stderr)
+my_resids = [resid for (resname, atomname, resid) in zip(m.column('resname'), m.column('atomname'), m.column('resid'))
+             if resname == b"GLY" and atomname == b"N"]
+first_resid = my_resids[0]
+for resid in my_resids:
+	print(resid - first_resid + 1)
@@ -1,182 +1,589 @@
 #!/usr/bin/env python
+#
+# Runs under Python 2.7 and 3. With NumPy installed, atoms are kept in one structured array
+# and parsed in bulk (with Numba too, if that's installed). Without NumPy, or under PyPy,
+# atoms are AtomRecord objects instead, and the plain Python loops are left to PyPy's JIT,
+# which is much faster at them than NumPy running through PyPy's C extension emulation.
+from __future__ import print_function
 import sys
+import os
+import gc
 import argparse
 import re
+import mmap
+import platform
+from multiprocessing import Pool, cpu_count
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    from numba import njit
+except ImportError:
+    # load_from_pdb falls back to str.find and NumPy conversions
+    njit = None
+use_numpy = np is not None and platform.python_implementation() != 'PyPy'
 
-class AtomRecord:
-    '''Represents a single atom.'''    
-    def __init__(self, line):
-        self.atomid = int(line[6:11])
-        self.atomname = line[12:16].strip()
-        self.resname = line[17:20].strip()
-        self.chain = line[21]
-        if self.chain == " ":
-             self.chain = "X"
+# One row per atom, in place of a Python object per atom.
+# The real valued columns are kept as raw PDB text, and only parsed by Molecule.real_field
+atom_fields = [('atomid', 'i4'), ('atomname', 'S4'), ('resname', 'S4'), ('chain', 'S1'),
+               ('resid', 'i4'), ('reals', 'S36'), ('ff_type', 'S16')]
+atom_dtype = np.dtype(atom_fields) if np is not None else None
+
+# PDB record columns of each real valued field. The reals text starts at column 30
+real_fields = {'x': (30, 38), 'y': (38, 46), 'z': (46, 54), 'occupancy': (54, 60), 'tempfactor': (60, 66)}
+
+def jit(f):
+    '''Compiles f with Numba, if it's installed.'''
+    return f if njit is None else njit(cache=True)(f)
+
+@jit
+def _line_end(buf, pos):
+    while pos < len(buf) and buf[pos] != 10: # '\n'
+        pos += 1
+    return pos
+
+@jit
+def _is_atom_record(buf, pos):
+    tag = b"ATOM  "
+    if pos + len(tag) > len(buf):
+        return False
+    for i in range(len(tag)):
+        if buf[pos + i] != tag[i]:
+            return False
+    return True
+
+@jit
+def _wanted_record(buf, pos, end, skip_names, skip_lengths):
+    '''Whether buf[pos:end] is an ATOM record whose residue name isn't one of skip_names.'''
+    if not _is_atom_record(buf, pos):
+        return False
+    first, last = pos + 17, min(pos + 20, end)
+    while first < last and buf[first] == 32:
+        first += 1
+    while last > first and buf[last - 1] == 32:
+        last -= 1
+    for k in range(len(skip_names)):
+        if skip_lengths[k] == last - first:
+            same = True
+            for i in range(last - first):
+                if buf[first + i] != skip_names[k, i]:
+                    same = False
+                    break
+            if same:
+                return False
+    return True
+
+@jit
+def _parse_int(field):
+    '''Returns (value, ok) for a space padded integer field.'''
+    i, n = 0, len(field)
+    while i < n and field[i] == 32: # ' '
+        i += 1
+    sign = 1
+    if i < n and (field[i] == 45 or field[i] == 43): # '-' or '+'
+        if field[i] == 45:
+            sign = -1
+        i += 1
+    value, ndigits = 0, 0
+    while i < n and field[i] >= 48 and field[i] <= 57:
+        value = value * 10 + (field[i] - 48)
+        ndigits += 1
+        i += 1
+    while i < n and field[i] == 32:
+        i += 1
+    return sign * value, ndigits > 0 and i == n
+
+@jit
+def scan_atom_records(buf, skip_names, skip_lengths):
+    '''Finds the ATOM records in buf, the uint8 contents of a PDB file, and converts their integer fields.
+    Residues named in skip_names (packed by name_table) are left out.
+    Returns the records padded to 80 bytes, atomids, resids, and where the first record
+    with a bad atom serial number starts (or -1), so the caller can report it.'''
+    natoms, pos = 0, 0
+    while pos < len(buf):
+        end = _line_end(buf, pos)
+        if _wanted_record(buf, pos, end, skip_names, skip_lengths):
+            natoms += 1
+        pos = end + 1
+
+    records = np.full((natoms, 80), 32, dtype=np.uint8)
+    atomid = np.empty(natoms, dtype=np.int32)
+    resid = np.empty(natoms, dtype=np.int32)
+    i, pos = 0, 0
+    while pos < len(buf):
+        end = _line_end(buf, pos)
+        if _wanted_record(buf, pos, end, skip_names, skip_lengths):
+            rec = records[i]
+            rec[:min(end - pos, 80)] = buf[pos:min(end, pos + 80)]
+            (atomid[i], ok) = _parse_int(rec[6:11])
+            if not ok:
+                return records, atomid, resid, pos
+            # Solvent residue ids are frequently mangled
+            # so just set the mangled ones to 0
+            (value, ok) = _parse_int(rec[22:26])
+            resid[i] = value if ok else 0
+            i += 1
+        pos = end + 1
+    return records, atomid, resid, -1
+
+@jit
+def _put_int(buf, pos, value, width):
+    '''Writes value into buf[pos:pos+width] right aligned, like %*d.'''
+    i, v = pos + width, abs(value)
+    while True:
+        i -= 1
+        if i < pos:
+            raise ValueError("Number too wide for its PSF column")
+        buf[i] = 48 + v % 10
+        v //= 10
+        if v == 0:
+            break
+    if value < 0:
+        i -= 1
+        if i < pos:
+            raise ValueError("Number too wide for its PSF column")
+        buf[i] = 45 # '-'
+    for j in range(pos, i):
+        buf[j] = 32
+
+# Bytes taken by "%8d %-4s %4d " in a PSF atom line, for PDB sized atomids, chains and resids
+psf_atom_head_size = 19
+
+@jit
+def write_atom_lines(buf, pos, atomid, chain, resid, kind_index, tail_bytes, tail_starts):
+    '''Writes the PSF atom lines into buf from pos on, returning where they end.
+    Each line is "%8d %-4s %4d " followed by tail_bytes[tail_starts[kind]:tail_starts[kind + 1]].'''
+    for k in range(len(atomid)):
+        _put_int(buf, pos, atomid[k], 8)
+        buf[pos + 8] = 32
+        buf[pos + 9] = chain[k]
+        for j in range(pos + 10, pos + 14):
+            buf[j] = 32
+        _put_int(buf, pos + 14, resid[k], 4)
+        buf[pos + 18] = 32
+        pos += psf_atom_head_size
+        (first, last) = (tail_starts[kind_index[k]], tail_starts[kind_index[k] + 1])
+        buf[pos:pos + last - first] = tail_bytes[first:last]
+        pos += last - first
+    return pos
+
+def name_table(names):
+    '''Packs up to 4 character names into a uint8 array and their lengths, for scan_atom_records.'''
+    names = sorted(names)
+    table = np.zeros((len(names), 4), dtype=np.uint8)
+    lengths = np.zeros(len(names), dtype=np.int64)
+    for (k, name) in enumerate(names):
+        table[k, :len(name)] = np.frombuffer(name, dtype=np.uint8)
+        lengths[k] = len(name)
+    return table, lengths
+
+def parse_atom_records(cols, numbers=None):
+    '''Parses an (N, 80) array of S1 holding PDB ATOM records into an array of atom_dtype.
+    numbers is (atomid, resid) from scan_atom_records, if the integer fields are already converted.'''
+    def field(first, last):
+        return np.ascontiguousarray(cols[:, first:last]).view('S%d' % (last - first)).ravel()
+
+    atoms = np.zeros(len(cols), dtype=atom_dtype)
+    atoms['atomname'] = np.char.strip(field(12, 16))
+    atoms['resname'] = np.char.strip(field(17, 20))
+    chain = field(21, 22)
+    atoms['chain'] = np.where(chain == b" ", b"X", chain)
+    atoms['reals'] = field(30, 66)
+    if numbers is not None:
+        (atoms['atomid'], atoms['resid']) = numbers
+        return atoms
+
+    # Check the serial numbers up front, since older NumPy can turn a whole column
+    # into garbage over one bad value, rather than raising
+    atomid = np.char.strip(field(6, 11))
+    valid = int_fields(atomid)
+    if not valid.all():
+        record = cols[np.argmin(valid)].tobytes().rstrip()
+        raise ValueError("Bad atom serial number in ATOM record: %r" % record)
+    atoms['atomid'] = atomid.astype('i4')
+    # Solvent residue ids are frequently mangled
+    # so just set the mangled ones to 0
+    resid = np.char.strip(field(22, 26))
+    valid = int_fields(resid)
+    atoms['resid'][valid] = resid[valid].astype('i4')
+    return atoms
+
+def int_fields(text):
+    '''Returns which of the stripped text fields are integers.'''
+    digits = np.char.lstrip(text, b"-+")
+    return np.char.isdigit(digits) & (np.char.str_len(text) - np.char.str_len(digits) <= 1)
+
+def shared_strings(column):
+    '''Returns a string column as a list, with one string object per distinct value rather than per atom.'''
+    (values, index) = np.unique(column, return_inverse=True)
+    return np.array(values.tolist(), dtype=object)[index].tolist()
+
+class AtomRecord(object):
+    '''Represents a single atom, when not using NumPy. Has the same fields as atom_dtype.'''
+    __slots__ = tuple(name for (name, format) in atom_fields)
+
+    def __init__(self, record):
+        self.atomid = int(record[6:11])
+        self.atomname = record[12:16].strip()
+        self.resname = record[17:20].strip()
+        self.chain = record[21:22]
+        if self.chain == b" ":
+            self.chain = b"X"
         # Solvent residue ids are frequently mangled
         # so just set the mangled ones to 0
-        try:
-            self.resid = int(line[22:26])
-        except:
-            self.resid = 0
-        self.x = float(line[30:38])
-        self.y = float(line[38:46])
-        self.z = float(line[46:54])
-        self.occupancy = float(line[54:60])
-        self.tempfactor = float(line[60:66])
-        
-        self.ff_type = ''
+        resid = record[22:26].strip()
+        digits = resid.lstrip(b"-+")
+        self.resid = int(resid) if digits.isdigit() and len(resid) - len(digits) <= 1 else 0
+        self.reals = record[30:66]
+        self.ff_type = b''
+
+def atom_records(pdb, skip_residues):
+    '''Yields the ATOM records in the mapped PDB file pdb, padded to 80 bytes, without Numba.'''
+    # Record starts are found by their preceding newline, so BOF is special
+    if pdb[0:6] == b"ATOM  ":
+        start = 0
+    else:
+        start = pdb.find(b"\nATOM  ") + 1 or -1
+    while start >= 0:
+        end = pdb.find(b"\n", start)
+        if end == -1:
+            end = len(pdb)
+        record = pdb[start:end]
+        if record[17:20].strip() not in skip_residues:
+            yield record.ljust(80)[:80]
+        start = pdb.find(b"\nATOM  ", end) + 1 or -1
+
+def native_str(name):
+    '''Returns a bytes name as a str, which it already is on Python 2.'''
+    return name if str is bytes else name.decode()
+
+# A line of a CHARMM topology file, with everything before any ! comment in group 1
+rtf_line_re = re.compile(br'(?m)^([^!\n]*)[^\n]*')
+
+class EmptyMap(bytes):
+    '''Stands in for the mmap of an empty file, which mmap refuses to map.'''
+    def close(self):
+        pass
+
+def map_file(filename):
+    '''Maps filename read-only into memory. Close the returned mmap when done.'''
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        if os.fstat(fd).st_size == 0:
+            return EmptyMap()
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    # Every reader goes through the file start to end, so ask for aggressive readahead.
+    # madvise is only there on Python 3.8+ (and not on Windows), in which case it's just a hint we skip
+    if hasattr(mm, 'madvise'):
+        mm.madvise(mmap.MADV_SEQUENTIAL)
+        mm.madvise(mmap.MADV_WILLNEED)
+    return mm
+
+# ITP lines that aren't data rows, by their first character
+itp_line_kinds = {b'[': 'section', b'#': 'directive', b';': 'skip', b'': 'skip'}
+
+def itp_data_lines(filename):
+    '''Yields (section, line) as bytes for each data row of a GROMACS ITP file, skipping ifdef blocks.'''
+    section = None
+    in_ifdef_block = False
+    with open(filename, 'rb') as itp:
+        # The same readahead hint map_file gives, for a file that's read rather than mapped.
+        # It's only a hint, so skip it where it's missing or refused (e.g. pipes)
+        if hasattr(os, 'posix_fadvise'):
+            try:
+                os.posix_fadvise(itp.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except OSError:
+                pass
+        for line in itp:
+            line = line.strip()
+            # Data rows aren't in itp_line_kinds, so they cost a single lookup
+            kind = itp_line_kinds.get(line[:1])
+            if kind == 'section':
+                # If we see a section marker, assume it's not [ atoms ], until it actually is
+                section = line[1:].split(b']', 1)[0].strip()
+                continue
+            elif kind == 'directive':
+                if line.startswith(b'#if'): # Skip ifdef blocks
+                    in_ifdef_block = True
+                    continue
+                elif line.startswith(b'#endif'):
+                    in_ifdef_block = False
+                    continue
+            elif kind == 'skip': # Skip comment and blank lines entirely
+                continue
+                
+            # Skip ifdef blocks!    
+            if in_ifdef_block == True:
+                continue
+            yield (section, line)
+
+def itp_atomtype(line):
+    '''Returns (ff_type, charge) for a row of an [ atomtypes ] section.'''
+    toks = line.split()
+    # Check the row's length up front rather than catching the failed unpacking,
+    # which would raise and catch an exception for every row of 6 column files
+    if len(toks) >= 7:
+        (ff_type, atomicnum, mass, charge, ptype, sigma, epsilon) = toks[0:7]
+        # Apparently here we can actually believe sigma and epsilon L-J parameters
+    else:
+        (ff_type, mass, charge, ptype, sigma, epsilon) = toks[0:6]
+    # print(ff_type, float(charge), file=sys.stderr)
+    return (ff_type, float(charge))
+
+def read_itp_charges(filename):
+    '''Returns {ff_type: charge} from the [ atomtypes ] section of an ITP file.
+    This is at module level so that multiprocessing can hand it to worker processes.'''
+    return dict(itp_atomtype(line) for (section, line) in itp_data_lines(filename) if section == b'atomtypes')
 
 class Molecule:
 
-    solvent_residues = ["WAT", "T3P", "HOH", "PW", "W"]
+    solvent_residues = frozenset((b"WAT", b"T3P", b"HOH", b"PW", b"W"))
 
-    def __init__(self, filename):
-        self.atoms = []
-        self.load_from_pdb(filename)
-        
-    def load_from_pdb(self, filename):
-        pdb = open(filename)
-        for line in pdb:
-            if line[0:6] == "ATOM  ":
-                atom = AtomRecord(line)
-                self.atoms.append(atom)
-        print >>sys.stderr, "Read %d atoms from %s." % (len(self.atoms), filename)
+    def __init__(self, filename, skip_residues=()):
+        self.load_from_pdb(filename, skip_residues)
         
+    def load_from_pdb(self, filename, skip_residues=()):
+        '''Reads the ATOM records from a PDB file, except for residues named in skip_residues.'''
+        # Map the whole file and hop from one ATOM record to the next, rather than
+        # reading (and allocating) every line in the file
+        pdb = map_file(filename)
+        buf = None
+        try:
+            if use_numpy and njit is not None:
+                buf = np.frombuffer(pdb, dtype=np.uint8)
+                (skip_names, skip_lengths) = name_table(skip_residues)
+                (records, atomid, resid, bad) = scan_atom_records(buf, skip_names, skip_lengths)
+                if bad >= 0:
+                    end = pdb.find(b"\n", bad)
+                    record = pdb[bad:end if end >= 0 else len(pdb)].rstrip()
+                    raise ValueError("Bad atom serial number in ATOM record: %r" % record)
+                self.atoms = parse_atom_records(records.view('S1'), (atomid, resid))
+            elif use_numpy:
+                records = b"".join(atom_records(pdb, frozenset(skip_residues)))
+                self.atoms = parse_atom_records(np.frombuffer(records, dtype='S1').reshape(-1, 80))
+            else:
+                self.atoms = [AtomRecord(record) for record in atom_records(pdb, frozenset(skip_residues))]
+        finally:
+            # The map can't be closed while anything still points into it,
+            # and compiling scan_atom_records can leave buf in a reference cycle
+            if buf is not None:
+                buf = None
+                gc.collect()
+            pdb.close()
+        print("Read %d atoms from %s." % (len(self.atoms), filename), file=sys.stderr)
+
+    def real_field(self, name):
+        '''Returns one of real_fields (x, y, z, occupancy or tempfactor) for every atom,
+        as float64 (or a list of floats without NumPy).
+        Nothing needs these to write a PSF, so they're only parsed when asked for.'''
+        (first, last) = real_fields[name]
+        if not use_numpy:
+            return [float(atom.reals[first - 30:last - 30]) for atom in self.atoms]
+        text = np.ascontiguousarray(self.atoms['reals']).view('S1').reshape(-1, 36)[:, first - 30:last - 30]
+        return np.ascontiguousarray(text).view('S%d' % (last - first)).ravel().astype('f8')
+
+    def column(self, name):
+        '''Returns a field (one of atom_fields or real_fields) for every atom, whichever way the atoms are stored.'''
+        if name in real_fields:
+            return self.real_field(name)
+        if not use_numpy:
+            return [getattr(atom, name) for atom in self.atoms]
+        return self.atoms[name]
+
     def nuke_solvent(self):
-        print >>sys.stderr, "Stripping solvent residues."
-        self.atoms = [atom for atom in self.atoms if atom.resname not in self.solvent_residues]
+        self.filter_atoms()
 
     def keep_only_atomname(self, atomname):
         '''Keeps only a certain type of atom. (e.g. CA, CB, N, ...)'''
-        print >>sys.stderr, "Keeping only %s atoms." % atomname
-        self.atoms = [atom for atom in self.atoms if atom.atomname == atomname]
+        self.filter_atoms(keep_atomname=atomname, drop_solvent=False)
+
+    def filter_atoms(self, keep_atomname=None, drop_solvent=True):
+        '''Strips solvent residues and/or keeps only atoms named keep_atomname, in a single pass.'''
+        if drop_solvent:
+            print("Stripping solvent residues.", file=sys.stderr)
+        if keep_atomname is not None:
+            print("Keeping only %s atoms." % keep_atomname, file=sys.stderr)
+            keep_atomname = keep_atomname.encode()
+        solvent = self.solvent_residues
+        if not use_numpy:
+            self.atoms = [atom for atom in self.atoms
+                          if (not drop_solvent or atom.resname not in solvent) and
+                             (keep_atomname is None or atom.atomname == keep_atomname)]
+            return
+        mask = np.ones(len(self.atoms), dtype=bool)
+        if drop_solvent:
+            mask &= ~np.isin(self.atoms['resname'], np.array(sorted(solvent), dtype='S4'))
+        if keep_atomname is not None:
+            mask &= self.atoms['atomname'] == keep_atomname
+        self.atoms = self.atoms[mask]
         
     def print_as_psf(self):
-        print "PSF CMAP"
-        print ""
-        print "       2 !NTITLE"
-        print " REMARKS Generated by pdb_to_psf.py, by Tom Joseph <thomas.joseph@mssm.edu>"
-        print " REMARKS Don't try MD with this, unless you're sure you know better than me"
-        print ""
-        print "%8d !NATOM" % len(self.atoms)
+        # Put the whole PSF together as bytes and hand it to stdout in a single write
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+        sys.stdout.flush()
+        header = (b"PSF CMAP\n"
+                  b"\n"
+                  b"       2 !NTITLE\n"
+                  b" REMARKS Generated by pdb_to_psf.py, by Tom Joseph <thomas.joseph@mssm.edu>\n"
+                  b" REMARKS Don't try MD with this, unless you're sure you know better than me\n"
+                  b"\n"
+                  b"%8d !NATOM\n" % len(self.atoms))
+        footer = b"\n" + b"".join([b"%8d !%s\n\n" % (0, section)
+                                   for section in (b"NBOND", b"NTHETA", b"NPHI", b"NIMPHI", b"NCRTERM")])
         
-        for atom in self.atoms:
-            print "%8d %-4s %4d %-4s %-4s %-4s %12.6f %10.4f 0" % \
-                (atom.atomid, atom.chain, atom.resid, atom.resname, atom.atomname, \
-                atom.ff_type, self.charges[atom.ff_type], 1.0)
-        
-        print "\n%8d !NBOND\n" % 0
-        print "%8d !NTHETA\n" % 0
-        print "%8d !NPHI\n" % 0
-        print "%8d !NIMPHI\n" % 0
-        print "%8d !NCRTERM\n" % 0
+        # Everything after the resid only depends on the (resname, atomname, ff_type) of the atom,
+        # and there are few of those, so each distinct tail of a line is formatted just once.
+        # That looks up each atom type's charge once too.
+        tail_format = b"%-4s %-4s %-4s %12.6f %10.4f 0\n"
+        if not use_numpy:
+            psf = [header]
+            tails = {}
+            for atom in self.atoms:
+                kind = (atom.resname, atom.atomname, atom.ff_type)
+                tail = tails.get(kind)
+                if tail is None:
+                    tail = tails[kind] = tail_format % (kind + (self.charges[atom.ff_type], 1.0))
+                psf.append(b"%8d %-4s %4d %s" % (atom.atomid, atom.chain, atom.resid, tail))
+            psf.append(footer)
+            out.write(b"".join(psf))
+            return
+
+        kinds = np.zeros(len(self.atoms), dtype=[(field, self.atoms.dtype[field]) for field in ('resname', 'atomname', 'ff_type')])
+        for field in kinds.dtype.names:
+            kinds[field] = self.atoms[field]
+        (kinds, kind_index) = np.unique(kinds, return_inverse=True)
+        tails = [tail_format % (resname, atomname, ff_type, self.charges[ff_type], 1.0)
+                 for (resname, atomname, ff_type) in kinds.tolist()]
+        if njit is None:
+            columns = [self.atoms['atomid'].tolist(), shared_strings(self.atoms['chain']),
+                       self.atoms['resid'].tolist(), np.array(tails, dtype=object)[kind_index].tolist()]
+            psf = [header]
+            psf.extend([b"%8d %-4s %4d %s" % row for row in zip(*columns)])
+            psf.append(footer)
+            out.write(b"".join(psf))
+            return
+
+        # Size the whole PSF up front, and have write_atom_lines format each atom's line
+        # straight into it, without making a string per line
+        tail_starts = np.zeros(len(tails) + 1, dtype=np.int64)
+        tail_starts[1:] = np.cumsum([len(tail) for tail in tails])
+        body_size = psf_atom_head_size * len(self.atoms) + int(np.diff(tail_starts)[kind_index].sum())
+        psf = bytearray(len(header) + body_size + len(footer))
+        psf[:len(header)] = header
+        write_atom_lines(np.frombuffer(psf, dtype=np.uint8), len(header),
+                         self.atoms['atomid'], np.ascontiguousarray(self.atoms['chain']).view(np.uint8),
+                         self.atoms['resid'], kind_index, np.frombuffer(b"".join(tails), dtype=np.uint8), tail_starts)
+        psf[len(header) + body_size:] = footer
+        out.write(psf)
         
     def add_charmm_topology(self, top_filename):
         """Adds topology information taken from CHARMM top_whatever.rtf file."""
         
-        nuke_comment_re = re.compile('!.*$') # Regexp to get rid of comments
-        top = open(top_filename, "r")
+        top = map_file(top_filename)
 
         # Parse CHARMM topology file to extract the atom partial charges.
         # We are only interested in ATOM, BOND, DIHE cards
         # contained in blocks delimited by RESI cards.
         # Apparently CHARMM autogenerates dihedrals?
-        current_residue = ""
+        current_residue = b""
         self.charge_by_type = {}
         bond_list = {}
-        while True:
-            l = top.readline()
-            if l == "": break # EOF
-            # Skip continuation line
-            if l.strip().endswith('-'):
-                top.readline()
-                continue
-            l = nuke_comment_re.sub('', l).strip()
-            if l == "": continue # There could be nothing left after stripping out comment
-            if l[0:4] == "RESI":
-                current_residue = l.split()[1] # Failure here? Either a bug or corrupted top file
-                self.charge_by_type[current_residue] = {}
-                bond_list[current_residue] = {}
-                # NTER and CTER specific atom charges
-                self.charge_by_type[current_residue]['NH3'] = -0.30
-                print >>sys.stderr, current_residue
-            elif l[0:4] == "ATOM":
-                (cardtype, atomname, atomtype, charge) = l.split()
-                charge = float(charge)
-                self.charge_by_type[current_residue][atomtype] = charge
-            elif l[0:4] == "BOND":
-                bonds = l.split()[1:]
-                for i in range(0, len(bonds), 2):
+        skip_next = False
+        try:
+            for m in rtf_line_re.finditer(top):
+                if skip_next:
+                    skip_next = False
+                    continue
+                # Skip continuation line
+                if m.group(0).strip().endswith(b'-'):
+                    skip_next = True
+                    continue
+                l = m.group(1).strip()
+                if l == b"": continue # There could be nothing left after stripping out comment
+                if l[0:4] == b"RESI":
+                    current_residue = l.split()[1] # Failure here? Either a bug or corrupted top file
+                    self.charge_by_type[current_residue] = {}
+                    bond_list[current_residue] = set()
+                    # NTER and CTER specific atom charges
+                    self.charge_by_type[current_residue][b'NH3'] = -0.30
+                    print(current_residue.decode(), file=sys.stderr)
+                elif l[0:4] == b"ATOM":
+                    (cardtype, atomname, atomtype, charge) = l.split()
+                    charge = float(charge)
+                    self.charge_by_type[current_residue][atomtype] = charge
+                elif l[0:4] == b"BOND":
+                    bonds = l.split()[1:]
                     # Order of atoms doesn't matter in a bond
-                    key1 = bonds[i] + '-' + bonds[i+1]
-                    key2 = bonds[i+1] + '-' + bonds[i]
-                    bond_list[current_residue][key1] = True
-                    bond_list[current_residue][key2] = True
-        
-        top.close()
+                    bond_list[current_residue].update(frozenset(pair) for pair in zip(bonds[0::2], bonds[1::2]))
+        finally:
+            top.close()
         
         # TODO: Make a bond table
-        print >>sys.stderr, "WARNING: No bond/angle/dihedral/improper information, yet!"
-        print >>sys.stderr, self.charge_by_type
+        print("WARNING: No bond/angle/dihedral/improper information, yet!", file=sys.stderr)
+        print(dict((native_str(residue), dict((native_str(atomtype), charge) for (atomtype, charge) in charges.items()))
+                   for (residue, charges) in self.charge_by_type.items()), file=sys.stderr)
         
     def add_atom_types_from_itp(self, itp_filenames):
         if len(self.atoms) == 0:
-            print >>sys.stderr, "BUG: Should have loaded atoms first"
+            print("BUG: Should have loaded atoms first", file=sys.stderr)
             sys.exit(1)
             
+        # [ atomtypes ] sections don't depend on each other, so with several files those are read in parallel,
+        # and the [ atoms ] pass below leaves them alone. Anything that isn't a regular file (a pipe, say)
+        # can only be read once, so it gets one pass for both sections, like a lone file does
+        pooled = [i for (i, filename) in enumerate(itp_filenames) if os.path.isfile(filename)]
+        if len(pooled) < 2:
+            pooled = []
+        charge_tables = [{} for filename in itp_filenames]
+        if pooled:
+            pool = Pool(min(len(pooled), cpu_count()))
+            try:
+                for (i, charges) in zip(pooled, pool.map(read_itp_charges, [itp_filenames[i] for i in pooled])):
+                    charge_tables[i] = charges
+            finally:
+                pool.close()
+                pool.join()
+
+        # [ atoms ] sections have to be matched up with the PDB atoms in order
         atom_i = 0
-        self.charges = {}
-            
-        for filename in itp_filenames:
-            in_atom_block, in_atomtypes_block = False, False
-            in_ifdef_block = False
-            itp = open(filename)
-            for line in itp:
-                line = line.strip()
-                # If we see a section marker, assume it's not [ atoms ], until it actually is
-                if line.startswith('[ atoms ]'):
-                    in_atom_block = True
-                    in_atomtypes_block = False
-                    continue
-                elif line.startswith('[ atomtypes ]'):
-                    in_atomtypes_block = True
-                    in_atom_block = False
-                    continue
-                elif line.startswith('[ '):
-                    in_atom_block, in_atomtypes_block = False, False
-                    continue
-                elif line.startswith('#if'): # Skip ifdef blocks
-                    in_ifdef_block = True
-                    continue
-                elif line.startswith('#endif'):
-                    in_ifdef_block = False
-                    continue
-                elif line.startswith(';') or line == '': # Skip comment and blank lines entirely
-                    continue
-                    
-                # Skip ifdef blocks!    
-                if in_ifdef_block == True:
-                    continue
-                
-                if in_atom_block == True:
+        ff_types = []
+        for (i, filename) in enumerate(itp_filenames):
+            read_atomtypes = i not in pooled
+            for (section, line) in itp_data_lines(filename):
+                if section == b'atoms':
                     toks = line.split()
                     (atomid, ff_type, resid, resname, atomname) = toks[0:5]
                     atomid, resid = int(atomid), int(resid)
-                    if self.atoms[atom_i].resid != resid:
-                        print >>sys.stderr, "WHOA! ITP mismatch: resid %d in PDB vs %d in ITP" % (self.atoms[atom_i].resid, resid)
+                    pdb_resid = self.atoms['resid'][atom_i] if use_numpy else self.atoms[atom_i].resid
+                    if pdb_resid != resid:
+                        print("WHOA! ITP mismatch: resid %d in PDB vs %d in ITP" % (pdb_resid, resid), file=sys.stderr)
                         sys.exit(1)
-                    self.atoms[atom_i].ff_type = ff_type
+                    ff_types.append(ff_type)
                     atom_i += 1
-                elif in_atomtypes_block == True:
-                    toks = line.split()
-                    try:
-                        (ff_type, atomicnum, mass, charge, ptype, sigma, epsilon) = toks[0:7]
-                        # Apparently here we can actually believe sigma and epsilon L-J parameters
-                    except:
-                        (ff_type, mass, charge, ptype, sigma, epsilon) = toks[0:6]
-                    self.charges[ff_type] = float(charge)
-                    # print >>sys.stderr, ff_type, float(charge)
-                    
+                elif section == b'atomtypes' and read_atomtypes:
+                    (ff_type, charge) = itp_atomtype(line)
+                    charge_tables[i][ff_type] = charge
+        # Later files win, as if they'd all been read in order
+        self.charges = {}
+        for charges in charge_tables:
+            self.charges.update(charges)
+        self.set_ff_types(ff_types)
+
+    def set_ff_types(self, ff_types):
+        '''Sets the ff_type of the first len(ff_types) atoms.'''
+        if not use_numpy:
+            for (atom, ff_type) in zip(self.atoms, ff_types):
+                atom.ff_type = ff_type
+            return
+        ff_types = np.array(ff_types, dtype='S')
+        # Widen the column rather than cut long type names short, which would break the charge lookup
+        if ff_types.dtype.itemsize > self.atoms.dtype['ff_type'].itemsize:
+            self.atoms = self.atoms.astype([(name, ff_types.dtype if name == 'ff_type' else self.atoms.dtype[name])
+                                            for name in self.atoms.dtype.names])
+        self.atoms['ff_type'][:len(ff_types)] = ff_types
                     
         
 if __name__ == "__main__":
@@ -185,12 +592,12 @@ if __name__ == "__main__":
     p.add_argument('-k', '--keep-atom', help='Atom name to keep')
     p.add_argument('-g', '--gromacs-itp', help='GROMACS ITP file, if you want correct force field atom types (can specify this argument multiple times as necessary)', action='append')
     p.add_argument('-c', '--charmm-top', help='CHARMM top_whatever.rtf file, which is not well tested')
+    p.add_argument('--nuke-solvent-early', help="Skip solvent while reading the PDB, which is much faster for solvated systems. Only use this if your ITP files don't list the solvent atoms", action='store_true')
     args = p.parse_args()
-    m = Molecule(args.pdb)
+    m = Molecule(args.pdb, Molecule.solvent_residues if args.nuke_solvent_early else ())
     if args.gromacs_itp is not None: m.add_atom_types_from_itp(args.gromacs_itp)
     if args.charmm_top is not None: m.add_charmm_topology(args.charmm_top)
-    m.nuke_solvent()
-    if args.keep_atom is not None: m.keep_only_atomname(args.keep_atom)
+    m.filter_atoms(keep_atomname=args.keep_atom)
     
     # TODO: renumber atomids?, since we probably deleted a bunch of atoms
     